@@ -0,0 +1,101 @@
+# ============================================================
+# File:         ExpiringDict.py
+# Description:
+# 	File contains the class object ExpiringDict, an OrderedDict
+#	of key -> timestamp capped both in length and in age, used
+#	for each first_contacts window. Entries are only dropped
+#	when its owner calls expire, so no separate cleaner thread
+#	or Lock is needed
+# ============================================================
+
+# ============================================================
+# Imports:
+# ============================================================
+# 	-	collections.OrderedDict: ExpiringDict inherits from
+#		OrderedDict, keeping entries oldest -> newest
+# ============================================================
+from collections import OrderedDict
+
+
+# ============================================================
+# Class: ExpiringDict
+# ============================================================
+# Description:
+# 	OrderedDict whose values are timestamps, written so that
+#	the least recently seen key is always at the front. Reads
+#	and writes are plain OrderedDict operations; trim drops
+#	the entries that overflow max_len, and expire also those
+#	that outlive max_age_seconds
+# ============================================================
+# Methods
+# ============================================================
+# ___init___:
+# 	Overrides the collections.OrderedDict constructor
+#	Input:
+#		-	max_len: most entries kept once trim or expire is
+#			called
+#		-	max_age_seconds: number of seconds maximum that a
+#			value is allowed to be kept
+#	Output:
+#		-	N/A
+#	Task:
+#		-	initialize as an empty OrderedDict
+#		-	assign the parameters to their respective attributes
+#
+# trim:
+#	Generator dropping every entry beyond max_len
+#	Input:
+#		-	N/A
+#	Output:
+#		-	yields each key as it is removed, so the caller can
+#			keep its own counters in step
+#	Task:
+#		-	while longer than max_len, pop the least recently
+#			seen entry from the front
+#
+# expire:
+#	Generator dropping every entry that overflows or is too old
+#	Input:
+#		-	now: time of reference, as returned by time.time
+#	Output:
+#		-	yields each key as it is removed, so the caller can
+#			keep its own counters in step
+#	Task:
+#		-	trim the entries beyond max_len
+#		-	then pop entries from the front while their
+#			timestamp (value) is older than max_age_seconds,
+#			putting the first live entry back at the front
+#		-	keys are moved to the end whenever they are written,
+#			so the first entry that has not expired ends the
+#			sweep
+# ============================================================
+class ExpiringDict( OrderedDict ):
+    ### CONSTRUCTOR __init___ ###
+    def __init__( self , max_len , max_age_seconds ):
+        super( ).__init__( )
+        self.max_len          =  max_len
+        self.max_age_seconds  =  max_age_seconds
+
+
+    ### METHOD trim ###
+    def trim( self ):
+        # === OVER CAPACITY, DROP THE LEAST RECENTLY SEEN FIRST === #
+        while len( self ) > self.max_len:
+            yield self.popitem( last=False )[0]
+
+
+    ### METHOD expire ###
+    def expire( self , now ):
+        yield from self.trim( )
+
+        # === OLDEST ENTRIES SIT AT THE FRONT, SO STOP AT THE FIRST FRESH ONE === #
+        cutoff  =  now - self.max_age_seconds # anything stamped before this has expired
+        while self:
+            key, timestamp  =  self.popitem( last=False )
+
+            # === IF KEY IS NOT EXPIRED, PUT IT BACK AT THE FRONT AND STOP === #
+            if timestamp >= cutoff:
+                self[key]  =  timestamp
+                self.move_to_end( key , last=False )
+                return
+            yield key
@@ -8,17 +8,84 @@
 #	of every recorded source IP for the past 1s, 1min, and 5mins.
 #	Program also will print that a scanner is detected if the
 #	rates surpass a certain threshold for the various rates,
-#	and specify which rate threshold was broken
+#	and specify which rate threshold was broken.
+#	Runs as its own process, fed first contacts by the Sniffer
+#	through a queue, so its work does not compete with packet
+#	capture for the GIL
 # ============================================================
 
 # ============================================================
 # Imports:
 # ============================================================
-# 	-	threading.Thread: DictCleaner inherits from Thread
-#	-	time.time: used to determine how old a packet is
+#	-	queue.Empty: raised when no contacts arrive in time
+#	-	queue.Queue: hands alert text to the printing thread
+#	-	socket, struct: used to format integer IPs when printing
+#	-	sys: alerts are written to sys.stdout in batches
+#	-	time.time: reference time when expiring the windows
+#	-	threading.Thread: runs print_alerts off the detection loop
+# 	-	multiprocessing.Process: FanOutRateCalculator inherits
+#		from Process
+#	-	ExpiringDict.ExpiringDict: first_contacts windows, capped
+#		in length and age, and kept in timestamp order so expired
+#		entries sit at the front
 # ============================================================
-from threading import Thread
-from time      import time
+import socket
+import struct
+import sys
+from time            import time
+from queue           import Empty, Queue
+from threading       import Thread
+from multiprocessing import Process
+from ExpiringDict    import ExpiringDict
+
+
+# ============================================================
+# Constants:
+# ============================================================
+#	-	AGES: the fan-out time intervals in seconds, one per
+#		first_contacts window (1=1s, 60=1min, 300=5mins)
+#	-	POLL_SECONDS: longest wait for contacts before the
+#		thresholds are checked anyway, and longest time spent
+#		draining queued contacts before they are checked
+#	-	MAX_PENDING_ALERTS: bound on alerts waiting to be printed
+#	-	MAX_CONTACTS: most first contacts kept in each window,
+#		the least recently seen are dropped beyond it
+# ============================================================
+AGES                =  ( 1 , 60 , 300 )
+POLL_SECONDS        =  0.25
+MAX_PENDING_ALERTS  =  1000
+MAX_CONTACTS        =  100000
+
+
+# ============================================================
+# Function: print_alerts
+# ============================================================
+# Description:
+#	Target of the alert printing thread, so console I/O never
+#	blocks the detection loop
+# Input:
+#	-	alerts: queue.Queue of alert strings, ended by None
+# Output:
+#	-	Alerts are written to console
+# Task:
+#	-	block until at least one alert is queued
+#	-	take every other alert already queued as well
+#	-	write them all with one sys.stdout.write and a single
+#		flush
+#	-	return once the None sentinel is taken
+# ============================================================
+def print_alerts( alerts ):
+    while True:
+        batch  =  [ alerts.get( ) ]
+        while not alerts.empty( ):
+            batch.append( alerts.get_nowait( ) )
+
+        # === WRITE EVERYTHING BEFORE A SENTINEL, THEN STOP IF ONE WAS TAKEN === #
+        done  =  None in batch
+        sys.stdout.write( ''.join( [ alert for alert in batch if alert is not None ] ) )
+        sys.stdout.flush( )
+        if done:
+            return
 
 
 # ============================================================
@@ -31,35 +98,90 @@ from time      import time
 # Methods
 # ============================================================
 # ___init___:
-# 	Overrides the threading.Thread constructor
+# 	Overrides the multiprocessing.Process constructor
 #	Input:
-#		-	first_contacts: shared dictionary object
-#		-	lock: threading.Lock object
+#		-	contacts_queue: multiprocessing.Queue of dictionaries
+#			of packed key -> timestamp contacts, filled by the
+#			Sniffer
+#		-	stop: multiprocessing.Event shared with the Sniffer,
+#			set when the program stops
 #	Output:
 #		-	N/A
 #	Task:
-#		-	initialize according to the parent class Thread.__init__
+#		-	initialize according to the parent class Process.__init__
 #		-	assign the parameters to their respective attributes
-#		-	set the attribute flag is_running to True
+#
+# record_contacts:
+#	Write a dictionary of contacts received from the Sniffer to the
+#	first_contacts windows
+#	Input:
+#		-	contacts: dictionary of packed key -> timestamp,
+#			oldest first
+#	Output:
+#		-	No values returned
+#		-	first_contacts windows and per_source_counts are
+#			updated
+#	Task:
+#		-	for every first_contacts window: if the key is not
+#			in the window yet, increment that window's counter
+#			in per_source_counts for the source IP
+#		-	(re)insert the key at the end of every window with
+#			the timestamp as the value, so entries stay sorted
+#			by timestamp for ExpiringDict.expire
+#		-	trim every window back to MAX_CONTACTS before
+#			returning, forgetting each contact dropped, so a
+#			window never holds more than one dictionary of
+#			contacts beyond its cap, however much is queued
+#
+# forget_contact:
+#	Keep per_source_counts in step with a key dropped from a window
+#	Input:
+#		-	key: packed key removed from the window
+#		-	i: index of the window it was removed from
+#	Output:
+#		-	No values returned
+#		-	per_source_counts is updated
+#	Task:
+#		-	decrement the window's counter for the source IP of
+#			the key, dropping the source once all of its
+#			counters reach 0
 #
 # run:
-#	Overrides the threading.Thread run function which is called
-#	when the thread is started.
+#	Overrides the multiprocessing.Process run function which is
+#	called in the child process when the process is started.
 #	Input:
 #		-	N/A
 #	Output:
 #		-	No values returned
 #		-	Output will be printed to console
 #	Task:
-#		-	This thread will iterate over the shared dictionary,
-#			counting the number of times each IP address is
-#			found within each of the desired time intervals
-#			(past 1s, past 1min, past 5mins)
-#		-	Once iteration is done, the lock is released, and
-#			the logged fan out rates are compared to their
+#		-	Create the first_contacts windows (past 1s, past
+#			1min, past 5mins), each capped at MAX_CONTACTS, the
+#			per_source_counts counters, and start a print_alerts
+#			thread
+#		-	until stopped, wait up to POLL_SECONDS for contacts
+#			from the queue, and record everything queued for up
+#			to POLL_SECONDS more, so expiry and the thresholds
+#			are never held off by a backlog
+#		-	expire each window, dropping its least recently seen
+#			entries beyond MAX_CONTACTS and those older than its
+#			interval, and forget each dropped contact
+#		-	copy the per-source counters, which already hold
+#			the number of first contacts of each IP address
+#			within each of the desired time intervals, so the
+#			first contacts themselves are never scanned
+#		-	skip any source whose 5min count is not above the
+#			lowest threshold, since the nested 1s and 1min
+#			counts can never be larger
+#		-	The copied fan out rates are compared to their
 #			respective thresholds
 #		-	if a rate exceeds its threshold, it is reported as
 #			a detected port scanner, and the IP is blacklisted.
+#			The report is queued for the print_alerts thread
+#			rather than printed inline. The 3 thresholds are
+#			compared directly rather than in a loop, and each
+#			IP's blacklist entry is a bitmask with one bit per
+#			threshold.
 #			Blacklist is structures so that the same IP may
 #			be reported once for surpassing each time threshold
 #				e.g.	192.168.10.1 may be reported once
@@ -67,76 +189,133 @@ from time      import time
 #						reported again later for exceeding the
 #						1min threshold, then a third time later
 #						for exceeding the 5min threshold
+#		-	once stopped, let print_alerts finish the queued
+#			alerts
 # ============================================================
-class FanOutRateCalculator( Thread ):
+class FanOutRateCalculator( Process ):
     ### CONSTRUCTOR __init___ ###
-    def __init__( self , first_contacts , lock ):
+    def __init__( self , contacts_queue , stop ):
         super( ).__init__( )
-        self.first_contacts   =  first_contacts
-        self.lock             =  lock
-        self.is_running       =  True
+        self.contacts_queue  =  contacts_queue
+        self.stop            =  stop
+
+
+    ### METHOD record_contacts ###
+    def record_contacts( self , contacts ):
+        first_contacts     =  self.first_contacts
+        per_source_counts  =  self.per_source_counts
+        for key, timestamp in contacts.items( ):
+            source  =  key >> 48 # top 32 bits of the packed key are the source IP
+            counts  =  per_source_counts.get( source )
+            if counts is None:
+                counts  =  per_source_counts[source]  =  [ 0 , 0 , 0 ]
+
+            # === RECORD THE CONTACT IN EVERY TIME WINDOW === #
+            for i, window in enumerate( first_contacts ):
+                if window.pop( key , None ) is None: # first contact within this window
+                    counts[i] +=  1
+                window[key]  =  timestamp # (re)inserted at the end, keeping the window ordered oldest -> newest
+
+        # === HOLD EVERY WINDOW TO ITS CAP, ONCE THE COUNTERS ABOVE ARE NO LONGER IN USE === #
+        forget_contact  =  self.forget_contact
+        for i, window in enumerate( first_contacts ):
+            for key in window.trim( ):
+                forget_contact( key , i )
+
+
+    ### METHOD forget_contact ###
+    def forget_contact( self , key , i ):
+        source  =  key >> 48
+        counts  =  self.per_source_counts[source]
+        counts[i] -=  1
+        if not any( counts ): # a window capped by length may drop a key the wider ones still hold
+            del self.per_source_counts[source]
 
 
     ### OVERRIDDEN METHOD run ###
     def run( self ):
+        # === STATE OWNED BY THIS PROCESS === #
+        self.first_contacts     =  tuple( ExpiringDict( MAX_CONTACTS , age ) for age in AGES ) # first contacts of the past 1s, 1min, 5mins
+        self.per_source_counts  =  dict( ) # key=source IP, value=[ entries in each first_contacts window ]
+        alerts                  =  Queue( maxsize=MAX_PENDING_ALERTS ) # alert text for the printing thread
+        printer                 =  Thread( target=print_alerts , args=( alerts , ) , daemon=True )
+        printer.start( )
+
         # === LOCAL VARIABLES === #
-        ages             =  [ 1 ,  60 , 300 ] # 1=1s, 60=1min, 300=5mins
+        ages             =  AGES
         max_connections  =  [ 5 , 100 , 300 ] # threshold connections for fan-out-rate to be scanner
-        blacklist        =  dict( )           # used to avoid printing the same IP for the same reason endlessly
+        min_connections  =  min( max_connections )
+        max_1s, max_1m, max_5m  =  max_connections # unpacked for the comparison, which is specialized to 3 intervals
+        blacklist        =  dict( )           # key=source IP, value=bitmask of thresholds already reported, to avoid printing the same IP for the same reason endlessly
+
+        # === LOOP LOOKUPS BOUND TO LOCALS ONCE === #
+        stopped            =  self.stop.is_set
+        receive            =  self.contacts_queue.get
+        receive_nowait     =  self.contacts_queue.get_nowait
+        clock              =  time
+        record_contacts    =  self.record_contacts
+        forget_contact     =  self.forget_contact
+        first_contacts     =  self.first_contacts
+        per_source_counts  =  self.per_source_counts
+        alert              =  alerts.put
 
         # === RUN UNTIL TOLD EXTERNALLY TO STOP === #
-        while self.is_running:
-            source_connections  =  dict( ) # key=source IP, value= [ connections in past 1s, past 1min, past 5mins]
+        while not stopped( ):
 
-            # === BLOCKING WAIT UNTIL LOCK IS ACQUIRED === #
-            with self.lock:
-                current_time  =  time( ) # timestamp at start of iteration, so all are considered from a static reference
+            # === WAIT FOR CONTACTS, THEN RECORD WHAT IS QUEUED FOR AT MOST POLL_SECONDS === #
+            try:
+                contacts  =  receive( timeout=POLL_SECONDS )
+                deadline  =  clock( ) + POLL_SECONDS
+                while True:
+                    record_contacts( contacts )
+                    if clock( ) >= deadline: # leave the rest queued until the thresholds are checked
+                        break
+                    contacts  =  receive_nowait( )
+            except Empty:
+                pass
 
-                # === ITERATE OVER KEYS IN SHARED DICTIONARY === #
-                for key in self.first_contacts.keys( ):
-                    source  =  key[0] # key[0] is the source IP
+            # === DROP OVERFLOWING AND EXPIRED CONTACTS FROM EVERY WINDOW === #
+            now  =  time( )
+            for i, window in enumerate( first_contacts ):
+                for key in window.expire( now ):
+                    forget_contact( key , i )
 
-                    # === CALCULATE RATES FOR ALL TIME INTERVALS AT ONCE === #
-                    for i in range( len( ages ) ): # 3, but made dynamic to be scalable
-                        if current_time - self.first_contacts[key] < ages[i]: # within the time-scope for calculation
-                            fan_out_rates               =  source_connections.get(source, [0,0,0]) # get current rates or default of all 0
-                            fan_out_rates[i]           +=  1 # increment rate for appropriate time scope
-                            source_connections[source]  =  fan_out_rates # store the updated value within a non-shared dict to safely release lock
+            # === COPY THE COUNTERS, SKIPPING QUIET SOURCES === #
+            # The windows are nested, so the 5min count bounds the other two: a
+            # source at or under the lowest threshold there cannot exceed any
+            source_connections  =  { source : tuple( counts ) for source, counts in per_source_counts.items( ) if counts[2] > min_connections } # key=source IP, value= ( connections in past 1s, past 1min, past 5mins )
 
             # === ITERATE OVER THE IP ADDRESSES RECORDED ABOVE === #
-            for key in source_connections.keys( ):
-                detected  =  False # Flag set if scanner is detected
-                reason    =  ''    # Dynamically produce "reason" text at runtime
-
-                # === COMPARE TO ALL THRESHOLDS === #
-                for i in range( len( max_connections ) ): # 3, but made dynamic for scalability
-
-                    # === IF CONNECTED MORE THAN THAT TIME INTERVAL'S THRESHOLD === #
-                    if source_connections[key][i] > max_connections[i]: # if it connected more than threshold
-
-                        # === IGNORE BLACKLISTED IP ADDRESSES === #
-                        if i in blacklist.get( key , list( ) ):
-                            continue
-                        # === NOT A BLACKLISTED IP ADDRESS === #
-                        else:
-                            detected        =  True # Flag Detection
-                            reason          =  'Reason: Fan-Out-Rate in the past {} seconds was {}  > {}'.format( ages[i] , source_connections[key][i] , max_connections[i] )
-                            blacklist[key]  =  blacklist.get( key ,list( ) ) + [i] # Blacklist source ip and reason in order to not print again
-                            break
-
-                # === IF ANY IP HAS SURPASSED ANY THRESHOLD === #
-                if detected:
-                    print( 'Port Scanner Detected from IP Address: {}'.format( key ) )
-                    fanout_per_1s = source_connections[key][2] / 300 # total connections / 300s (5min window)
-                    fanout_per_1m = source_connections[key][1] / 5   # total connections / 5m (5min window
-                    fanout_per_5m = source_connections[key][0] # total connections in past 5mins
-
-                    # === PRINT FAN OUT RATE FOR ALL INTERVALS === #
-                    print( '   Average Fan-Out Rate Per-Second Over the Last 5mins: {}'.format( fanout_per_1s ) )
-                    print( '   Average Fan-Out Rate Per-Minute Over the Last 5mins: {}'.format( fanout_per_1m ) )
-                    print( '   Average Fan-Out Rate Per-5-Minutes Over the Last 5mins: {}'.format( fanout_per_5m ) )
+            for key, counts in source_connections.items( ):
+                reported  =  blacklist.get( key , 0 ) # bit i is set once the IP was reported for max_connections[i]
+
+                # === FIRST THRESHOLD EXCEEDED AND NOT YET REPORTED, CHECKED 1s, 1min, THEN 5mins === #
+                if counts[0] > max_1s and not reported & 1:
+                    i  =  0
+                elif counts[1] > max_1m and not reported & 2:
+                    i  =  1
+                elif counts[2] > max_5m and not reported & 4:
+                    i  =  2
+                else:
+                    continue
+
+                # === THIS IP HAS SURPASSED A THRESHOLD === #
+                reason          =  'Reason: Fan-Out-Rate in the past {} seconds was {}  > {}'.format( ages[i] , counts[i] , max_connections[i] )
+                blacklist[key]  =  reported | ( 1 << i ) # Blacklist source ip and reason in order to not print again
+                fanout_per_1s = counts[2] / 300 # total connections / 300s (5min window)
+                fanout_per_1m = counts[1] / 5   # total connections / 5m (5min window
+                fanout_per_5m = counts[0] # total connections in past 5mins
+
 #                    for i in range( len( max_connections ) ): # 3, but left dynamic for scalability
 #                        print( '   Fan-Out-Rate Per {}s (over past 5mins): {}'.format( ages[i] , ages[i] , source_connections[key][i] ) )
 
-                    print( reason )
-                    print( '' )
+                # === QUEUE THE REPORT, WITH FAN OUT RATE FOR ALL INTERVALS, FOR THE PRINTING THREAD === #
+                alert( 'Port Scanner Detected from IP Address: {}\n'.format( socket.inet_ntoa( struct.pack( '!I' , key ) ) ) +
+                       '   Average Fan-Out Rate Per-Second Over the Last 5mins: {}\n'.format( fanout_per_1s ) +
+                       '   Average Fan-Out Rate Per-Minute Over the Last 5mins: {}\n'.format( fanout_per_1m ) +
+                       '   Average Fan-Out Rate Per-5-Minutes Over the Last 5mins: {}\n'.format( fanout_per_5m ) +
+                       reason + '\n\n' )
+
+        # === STOP THE PRINTING THREAD BEFORE THE PROCESS EXITS === #
+        alerts.put( None ) # printed after every alert already queued
+        printer.join( )
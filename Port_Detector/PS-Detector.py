@@ -5,82 +5,99 @@
 # Description:
 # 	Main file for this project. When this script is run, it
 #	will perform a multithreaded approach to detecting a port
-#	scanner ustilizing Sniffer.py, DictCleaner.py, and
-#	FanOutRateCalculator.py each as an independent thread
-#	with shared resources.
+#	scanner ustilizing Sniffer.py as a thread of this process,
+#	and FanOutRateCalculator.py as a separate process (which
+#	expires its own ExpiringDict.py windows), connected by a
+#	queue.
 # ============================================================
 
 # ============================================================
 # Imports:
 # ============================================================
-#	-	threading: used for initializing the threading objects
-#		and operating upon them
+#	-	multiprocessing: used for the queue connecting the
+#		Sniffer thread to the FanOutRateCalculator process, and
+#		the stop event shared by both
+#	-	signal: Ctrl+C (SIGINT) is blocked and waited for, then
+#		the stop event is set
 #	-	Sniffer.Sniffer: Sniffer class defined in Sniffer.py
-#	-	DictCleaner.DictCleaner: DictCleaner class defined in
-#		DictCleaner.py
 #	-	FanOutRateCalculator.FanOutRateCalculator:
 #		FanOutRateCalculator class defined in FanOutRateCalculator.py
 # ============================================================
-import threading
+import multiprocessing
+import signal
 from Sniffer              import Sniffer
-from DictCleaner          import DictCleaner
 from FanOutRateCalculator import FanOutRateCalculator
 
 
+# ============================================================
+# Constants:
+# ============================================================
+#	-	MAX_QUEUED_CONTACTS: most dictionaries of contacts the
+#		queue holds before the Sniffer drops new ones, bounding
+#		the backlog (and detection latency) when the
+#		FanOutRateCalculator falls behind
+# ============================================================
+MAX_QUEUED_CONTACTS  =  1024
+
 # ============================================================
 # Function: detect_ps
 # ============================================================
 # Description:
 #	Main driver function for this program, initializing the
 #	threaded classes imported above, and running them in
-#	in parallel until an 'x' or an 'X' is input, which terminates
-#	the program.
+#	in parallel until Ctrl+C is pressed, which terminates the
+#	program.
 # Input:
 #	-	N/A
 # Output:
 #	-	N/A
 # Task:
-#	-	Initialize Shared resource variables for the threads
-#	-	Initialize and start each of the thread objects impored
-#	-	Keep the function running in a while loop until 'x' or
-#		'X' is input into the console
-#	-	Set each thread's keep_running attribute to False
-#		so that they they can safely terminates
-#	-	join each thread into main to preven hanging on program
-#		termination
+#	-	Initialize the queue, bounded by MAX_QUEUED_CONTACTS,
+#		and the stop event shared by the thread and process
+#	-	Block SIGINT before anything else is started, so the
+#		thread and process inherit the blocked mask and Ctrl+C
+#		is never delivered to them
+#	-	Initialize and start the process and thread objects
+#		imported, the process first so it is not forked while
+#		the thread is running
+#	-	Wait in signal.sigwait until Ctrl+C is pressed, then
+#		set the stop event, which lets the thread and process
+#		safely terminate. No signal handler touches the event,
+#		since its lock could already be held by the code the
+#		handler interrupted
+#	-	join each of them into main to preven hanging on program
+#		termination, without waiting on contacts still queued
+#	-	report how many contacts the Sniffer dropped because
+#		the queue was full, if any
 # ============================================================
 def detect_ps( ):
     # === SHARED VARIABLES === #
-    first_contacts  =  dict( )
-    lock            =  threading.Lock( )
+    contacts_queue  =  multiprocessing.Queue( maxsize=MAX_QUEUED_CONTACTS ) # dictionaries of contacts, Sniffer -> FanOutRateCalculator
+    stop            =  multiprocessing.Event( ) # set once, ends the Sniffer and FanOutRateCalculator loops
 
-    # === INITIALIZE THREAD OBJECTS === #
-    sniffer                  =  Sniffer( first_contacts , lock )
-    cleanup                  =  DictCleaner( first_contacts , lock )
-    fan_out_rate_calculator  =  FanOutRateCalculator( first_contacts , lock )
+    # === BLOCK CTRL+C HERE AND IN THE THREAD AND PROCESS STARTED BELOW === #
+    signal.pthread_sigmask( signal.SIG_BLOCK , { signal.SIGINT } )
 
-    # === START THE TREADS === #
-    sniffer.start( )
-    cleanup.start( )
+    # === INITIALIZE THREAD AND PROCESS OBJECTS === #
+    sniffer                  =  Sniffer( contacts_queue , stop )
+    fan_out_rate_calculator  =  FanOutRateCalculator( contacts_queue , stop ) # expires its own windows
+
+    # === START THE PROCESS, THEN THE THREAD === #
     fan_out_rate_calculator.start( )
+    sniffer.start( )
 
     # === RUN UNTIL USER TELLS PROGRAM TO STOP === #
-    print( '[+] Enter \'x\' to Stop Detecting' )
-    while True:
-        x  =  input( )
-        if x in 'xX':
-            print( '[*] Terminating Threads...' )
-            break
-
-    # === ALLOW THREADS TO ESCAPE THEIR INFINITE LOOPS === #
-    sniffer.is_running                  =  False
-    cleanup.is_running                  =  False
-    fan_out_rate_calculator.is_running  =  False
+    print( '[+] Press Ctrl+C to Stop Detecting' )
+    signal.sigwait( { signal.SIGINT } ) # takes the pending Ctrl+C, however early it arrived
+    stop.set( )
+    print( '[*] Terminating Threads...' )
 
     # === JOIN TO MAIN THREAD TO PREVENT HANGING
     sniffer.join( )
-    cleanup.join( )
     fan_out_rate_calculator.join( )
+    contacts_queue.cancel_join_thread( ) # contacts left in the queue are not needed anymore
+    if sniffer.dropped_contacts:
+        print( '[*] Dropped {} contacts while the detector was behind'.format( sniffer.dropped_contacts ) )
 
     # === EXIT DRIVER FUNCTION === #
     return
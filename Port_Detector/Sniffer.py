@@ -6,43 +6,144 @@
 # 	Adopted from Lab4, this packet sniffer has been constructed
 #   as a class which inherits from threading.Thread. This
 #	sniffer will constantly monitor traffic for as long as
-#	its own thread
+#	its own thread, sending what it sees to the
+#	FanOutRateCalculator process through a queue
 # ============================================================
 
 # ============================================================
 # Imports:
 # ============================================================
+#	-	ctypes: used to call libc's recvmmsg, which has no
+#		socket module equivalent
+#	-	errno, os: used to report recvmmsg failures
+#	-	select: used to wait for packets with a timeout
 #	-	socket: used for network connections
 #	-	struct: used for unworking network packets
 #	-	time.time: used to determine how old a packet is
-# 	-	threading.Thread: DictCleaner inherits from Thread
+#	-	queue.Full: raised when the contacts queue is full
+# 	-	threading.Thread: Sniffer inherits from Thread
 # ============================================================
+import ctypes
+import errno
+import os
+import select
 import socket
 import struct
 import time
+from queue     import Full
 from threading import Thread
 
 
+# ============================================================
+# Constants:
+# ============================================================
+#	-	PACKET_HEADERS: precompiled layout of the only header
+#		fields run needs, read straight from the raw frame
+#			offset 26:	source IP as 32-bit int (I)
+#			offset 30:	destination IP as 32-bit int (I)
+#			offset 36:	TCP/UDP destination port (H)
+#		assumes a 20 byte IPv4 header, as ipv4_dissect does
+#	-	BATCH_SIZE: max number of packets read per recvmmsg
+#	-	BUFFER_SIZE: bytes kept per packet, plenty for the
+#		headers parse reads (the rest of the frame is dropped)
+#	-	MSG_DONTWAIT: recvmmsg flag to return instead of block
+#	-	FLUSH_SIZE, FLUSH_INTERVAL: pending contacts are sent
+#		to the contacts queue once this many are buffered, or
+#		this many seconds after the previous send
+#	-	SO_ATTACH_FILTER: Linux socket option for attaching a
+#		BPF program, missing from the socket module
+#	-	PACKET_FILTER: classic BPF program run by the kernel on
+#		every frame, as ( code , jt , jf , k ) instructions.
+#		Frames it rejects never reach this process:
+#			0:	ldh [12]			ethernet protocol
+#			1:	jeq #0x0800, 2, 8	IPv4 only
+#			2:	ldb [23]			IP protocol
+#			3:	jeq #6, 5, 4		TCP
+#			4:	jeq #17, 5, 8		or UDP
+#			5:	ldh [20]			IP flags + fragment offset
+#			6:	jset #0x1fff, 8, 7	later fragments carry no ports
+#			7:	ret #38				keep, truncated to PACKET_HEADERS
+#			8:	ret #0				drop
+#	-	BYTE_STRINGS, BYTE_HEX_STRINGS: decimal and uppercase
+#		2-digit hex text of every byte value, so the format
+#		methods only look strings up instead of building them
+#	-	LIBC: handle to the C library providing recvmmsg
+# ============================================================
+PACKET_HEADERS    =  struct.Struct( '!26x I I 2x H' )
+BATCH_SIZE        =  64
+BUFFER_SIZE       =  2048
+MSG_DONTWAIT      =  0x40
+FLUSH_SIZE        =  64
+FLUSH_INTERVAL    =  0.05
+SO_ATTACH_FILTER  =  26
+PACKET_FILTER     =  ( ( 0x28 , 0 , 0 , 12 ) ,
+                       ( 0x15 , 0 , 6 , 0x0800 ) ,
+                       ( 0x30 , 0 , 0 , 23 ) ,
+                       ( 0x15 , 1 , 0 , 6 ) ,
+                       ( 0x15 , 0 , 3 , 17 ) ,
+                       ( 0x28 , 0 , 0 , 20 ) ,
+                       ( 0x45 , 1 , 0 , 0x1fff ) ,
+                       ( 0x06 , 0 , 0 , PACKET_HEADERS.size ) ,
+                       ( 0x06 , 0 , 0 , 0 ) )
+BYTE_STRINGS      =  [ str( i ) for i in range( 256 ) ]
+BYTE_HEX_STRINGS  =  [ '{:02X}'.format( i ) for i in range( 256 ) ]
+LIBC              =  ctypes.CDLL( 'libc.so.6' , use_errno=True )
+
+
+# ============================================================
+# Classes: IOVec, MsgHdr, MMsgHdr
+# ============================================================
+# Description:
+#	ctypes mirrors of the C structs struct iovec, struct msghdr
+#	and struct mmsghdr, describing the receive buffers handed
+#	to recvmmsg
+# ============================================================
+class IOVec( ctypes.Structure ):
+    _fields_  =  [ ( 'iov_base' , ctypes.c_void_p ) ,
+                   ( 'iov_len'  , ctypes.c_size_t ) ]
+
+
+class MsgHdr( ctypes.Structure ):
+    _fields_  =  [ ( 'msg_name'       , ctypes.c_void_p ) ,
+                   ( 'msg_namelen'    , ctypes.c_uint32 ) ,
+                   ( 'msg_iov'        , ctypes.POINTER( IOVec ) ) ,
+                   ( 'msg_iovlen'     , ctypes.c_size_t ) ,
+                   ( 'msg_control'    , ctypes.c_void_p ) ,
+                   ( 'msg_controllen' , ctypes.c_size_t ) ,
+                   ( 'msg_flags'      , ctypes.c_int ) ]
+
+
+class MMsgHdr( ctypes.Structure ):
+    _fields_  =  [ ( 'msg_hdr' , MsgHdr ) ,
+                   ( 'msg_len' , ctypes.c_uint ) ]
+
+
+LIBC.recvmmsg.argtypes  =  [ ctypes.c_int , ctypes.POINTER( MMsgHdr ) , ctypes.c_uint , ctypes.c_int , ctypes.c_void_p ]
+LIBC.recvmmsg.restype   =  ctypes.c_int
+
+
 # ============================================================
 # Class: Sniffer
 # ============================================================
 # Description:
 # 	Utility class used for capturing communication package
-#	information and logging it in a thread-safe way
+#	information and sending it on through a process-safe queue
 # ============================================================
 # Methods
 # ============================================================
 # ___init___:
 # 	Overrides the threading.Thread constructor
 #	Input:
-#		-	first_contacts: shared dictionary object
-#		-	lock: threading.Lock object
+#		-	contacts_queue: multiprocessing.Queue the recorded
+#			contacts are sent through to the FanOutRateCalculator
+#		-	stop: multiprocessing.Event shared with the
+#			FanOutRateCalculator, set when the program stops
 #	Output:
 #		-	N/A
 #	Task:
 #		-	initialize according to the parent class Thread.__init__
 #		-	assign the parameters to their respective attributes
-#		-	set the attribute flag is_running to True
+#		-	set the dropped_contacts counter to 0
 #
 #
 # mac_format
@@ -55,9 +156,9 @@ from threading import Thread
 #			of 2 characters at a time, separated by colons,
 #			all uppercase
 #	Task:
-#		-	map the input into a {:02x} using string.format
-#		-	convert the map into a string of uppercase letters
-#		-	return the resulting string
+#		-	look up each byte's uppercase {:02X} text in
+#			BYTE_HEX_STRINGS
+#		-	join the pieces and return the resulting string
 #
 #
 # ipv4_format:
@@ -68,8 +169,8 @@ from threading import Thread
 #	Output:
 #		-	string format of the input address
 #	Task:
-#		-	map the input to strings
-#		-	join the mappings together using a '.' characters
+#		-	look up each of the 4 bytes in BYTE_STRINGS
+#		-	join them together using '.' characters
 #		-	return the resulting string
 #
 #
@@ -164,6 +265,38 @@ from threading import Thread
 #		-	Return these extracted values
 #
 #
+# parse:
+#	Single-pass replacement for the dissect chain used by run.
+#	Reads only the fields needed for a first-contact key with
+#	one precompiled struct, without slicing or formatting.
+#	Frames are expected to have passed PACKET_FILTER, so the
+#	protocols are not checked again
+#	Input:
+#		-	ethernet_data: raw packet data at the ethernet level
+#	Output:
+#		-	( Source IP , Destination IP , Destination Port ),
+#			with both IPs as 32-bit ints
+#		-	None for a truncated packet
+#	Task:
+#		-	unpack PACKET_HEADERS from the start of the frame
+#		-	return the key fields listed in "Output"
+#
+#
+# attach_filter:
+#	Attach PACKET_FILTER to a raw socket so the kernel drops
+#	everything but TCP/UDP over IPv4 before it is copied out
+#	Input:
+#		-	packets: raw PF_PACKET socket
+#	Output:
+#		-	N/A
+#	Task:
+#		-	pack PACKET_FILTER into an array of struct
+#			sock_filter
+#		-	pass a struct sock_fprog pointing at it to
+#			setsockopt( SO_ATTACH_FILTER ), which copies the
+#			program into the kernel
+#
+#
 # run:
 #	Overrides the threading.Thread run function which is called
 #	when the thread is started.
@@ -171,46 +304,58 @@ from threading import Thread
 #		-	N/A
 #	Output:
 #		-	No values returned
-#		-	Shared first_contacts dictionary will be given
-#			new/updated timestamp values as the thread runs
+#		-	Dictionaries of contacts will be put on
+#			contacts_queue as the thread runs
 #	Task:
 #		-	Set up the thread to receive raw packet data, with
-#			a fixed timeout
-#		-	until the is_running flag is externally set to False,
-#			the thread will continue to receive incoming packets
-#		-	Attempt to receive packet data, or re-iterate
-#			if there is a timeout
-#		-	ethernet_dissect the raw packet data
-#		-	if the packet code represents IPv4, ipv4_dissect
-#			the packet
-#		-	either tcp_dissect, udp_dissect, or icmp_dissect
-#			based on the IP porotocol
-#		-	if the tuple (Source IP, Destination IP, Destination
-#			Port) is unique, add it to the shared first_contacts
-#			shared dictionary, with the tuple as the key, and the
-#			time.time() timestamp as the values
-#		-	Otherwise, update the existing timestamp in the
-#			shared dictionary
+#			PACKET_FILTER attached, and the BATCH_SIZE buffers
+#			recvmmsg fills
+#		-	Discard any packets queued before the filter was in
+#			place
+#		-	until the stop event is externally set, the thread
+#			will continue to receive incoming packets
+#		-	Bind the callables and attributes used per packet
+#			to locals before the loop starts
+#		-	Wait for packet data with a fixed timeout, or
+#			re-iterate if there is a timeout
+#		-	Receive up to BATCH_SIZE packets with one recvmmsg
+#			call
+#		-	parse the raw data of each packet, all of which are
+#			TCP or UDP over IPv4 thanks to PACKET_FILTER
+#		-	pack (Source IP, Destination IP, Destination Port)
+#			into a single int key: source IP in bits 48-79,
+#			destination IP in bits 16-47, port in bits 0-15
+#		-	write the key with the batch's time.time() timestamp
+#			into a thread-local pending dictionary, re-inserting
+#			it if already there so the dictionary stays in
+#			timestamp order and a busy flow is only sent once
+#		-	once FLUSH_SIZE keys are pending, or FLUSH_INTERVAL
+#			seconds have passed since the last flush, put the
+#			pending dictionary on the contacts queue as one item
+#			and swap in an empty one, so the Sniffer never waits
+#			on the FanOutRateCalculator
+#		-	if the contacts queue is full, drop the pending
+#			dictionary and add its size to dropped_contacts
+#			rather than block packet capture
 #
 # ============================================================
 class Sniffer( Thread ):
     ### ___init___ CONSTRUCTOR ###
-    def __init__( self , first_contacts , lock ):
+    def __init__( self , contacts_queue , stop ):
         super( ).__init__( )
-        self.first_contacts  =  first_contacts
-        self.lock            =  lock
-        self.is_running      =  True
+        self.contacts_queue    =  contacts_queue
+        self.stop              =  stop
+        self.dropped_contacts  =  0 # contacts discarded because the contacts queue was full
 
 
     ### METHOD mac_format ###
     def mac_format( mac ):
-        mac = map( '{:02x}'.format , mac )
-        return ''.join( mac ).upper( )
+        return ''.join( [ BYTE_HEX_STRINGS[byte] for byte in mac ] )
 
 
     ### METHOD ipv4_format ###
     def ipv4_format( address ):
-        return '.'.join( map( str , address ) )
+        return BYTE_STRINGS[address[0]] + '.' + BYTE_STRINGS[address[1]] + '.' + BYTE_STRINGS[address[2]] + '.' + BYTE_STRINGS[address[3]]
 
 
     ### METHOD ethernet_dissect ###
@@ -243,50 +388,86 @@ class Sniffer( Thread ):
         return icmp_type, icmp_code
 
 
-    ### OVERRIDDEN METHOD run ###
-    def run( self ):
-        packets  =  socket.socket( socket.PF_PACKET , socket.SOCK_RAW , socket.htons( 0x0800 ) )
-        packets.settimeout( 5 ) # 5 second timeout to prevent hanging on recvfrom
+    ### METHOD parse ###
+    def parse( ethernet_data ):
+        if len( ethernet_data ) < PACKET_HEADERS.size:
+            return None
+        return PACKET_HEADERS.unpack_from( ethernet_data ) # PACKET_FILTER already kept only TCP/UDP over IPv4
 
-        # === ITERATE UNLESS STOPPED EXTERNALLY === #
-        while self.is_running:
 
-            # === TRY RECEIVING WITH TIMEIOUT === #
-            try:
-                ethernet_data, address  =  packets.recvfrom( 65536 )
+    ### METHOD attach_filter ###
+    def attach_filter( packets ):
+        program  =  ctypes.create_string_buffer( b''.join( struct.pack( 'HBBI' , *instruction ) for instruction in PACKET_FILTER ) )
+        packets.setsockopt( socket.SOL_SOCKET , SO_ATTACH_FILTER , struct.pack( 'HP' , len( PACKET_FILTER ) , ctypes.addressof( program ) ) ) # struct sock_fprog
 
-            # === RE-ITERATE ON TIMEOUT === #
-            except socket.timeout:
-                continue
 
-            # === ETHERNET DISSECT === #
-            dest_mac, src_mac, protocol, ip_data  =  Sniffer.ethernet_dissect( ethernet_data )
+    ### OVERRIDDEN METHOD run ###
+    def run( self ):
+        packets  =  socket.socket( socket.PF_PACKET , socket.SOCK_RAW , socket.htons( 0x0800 ) )
+        packets.setblocking( False ) # select provides the 5 second timeout, recvmmsg must never block
+        Sniffer.attach_filter( packets )
 
-            # === IF IPV4 === #
-            if protocol == 8:
+        # === RECEIVE BUFFERS, SET UP ONCE AND REUSED FOR EVERY BATCH === #
+        buffers   =  ( ctypes.c_char * BUFFER_SIZE * BATCH_SIZE )( )
+        iovecs    =  ( IOVec * BATCH_SIZE )( )
+        messages  =  ( MMsgHdr * BATCH_SIZE )( )
+        views     =  [ ] # zero-copy views of each buffer for parse
+        for i in range( BATCH_SIZE ):
+            iovecs[i].iov_base              =  ctypes.addressof( buffers[i] )
+            iovecs[i].iov_len               =  BUFFER_SIZE
+            messages[i].msg_hdr.msg_iov     =  ctypes.pointer( iovecs[i] )
+            messages[i].msg_hdr.msg_iovlen  =  1
+            views.append( memoryview( buffers[i] ).cast( 'B' ) )
 
-                # === IPV4 DISSECT === #
-                ip_protocol, src_ip, dest_ip, transport_data = Sniffer.ipv4_dissect( ip_data )
-                contact  =  False
+        # === DROP ANYTHING QUEUED BEFORE THE FILTER WAS ATTACHED === #
+        while LIBC.recvmmsg( packets.fileno( ) , messages , BATCH_SIZE , MSG_DONTWAIT , None ) > 0:
+            pass
 
-                # === IF TCP === #
-                if ip_protocol == 6: # TCP
+        pending     =  { } # packed key -> timestamp, not yet sent to the FanOutRateCalculator
+        last_flush  =  time.time( )
 
-                    # === TCP DISSECT === #
-                    src_port, dest_port  =  Sniffer.tcp_dissect( transport_data )
-                    contact = True
+        # === HOT LOOP LOOKUPS BOUND TO LOCALS ONCE === #
+        parse     =  Sniffer.parse
+        clock     =  time.time
+        wait_for  =  select.select
+        recvmmsg  =  LIBC.recvmmsg
+        send      =  self.contacts_queue.put_nowait
+        fd        =  packets.fileno( )
+        watched   =  [ packets ]
+        stopped   =  self.stop.is_set
+
+        # === ITERATE UNLESS STOPPED EXTERNALLY === #
+        while not stopped( ):
 
-                # === OTHERWISE IF UDP === #
-                elif ip_protocol == 17: # UDP
+            # === WAIT FOR PACKETS WITH TIMEOUT, SHORTER WHILE CONTACTS ARE PENDING === #
+            ready, _, _  =  wait_for( watched , [ ] , [ ] , FLUSH_INTERVAL if pending else 5 ) # 5 second timeout to prevent hanging
 
-                    # === UDP DISSECT === #
-                    src_port, dest_port  =  Sniffer.udp_dissect( transport_data )
-                    contact  =  True
+            # === RECEIVE UP TO BATCH_SIZE PACKETS WITH ONE SYSCALL === #
+            if ready:
+                received  =  recvmmsg( fd , messages , BATCH_SIZE , MSG_DONTWAIT , None )
+                if received < 0:
+                    error  =  ctypes.get_errno( )
+                    if error not in ( errno.EAGAIN , errno.EINTR ):
+                        raise OSError( error , os.strerror( error ) )
+                    received  =  0
 
-                # === TCP OR UDP ONLY === #
-                if contact:
-                    key  =  ( src_ip , dest_ip , dest_port )
+                # === PARSE THE BATCH INTO THE LOCAL PENDING LIST === #
+                now     =  clock( )
+                remove  =  pending.pop
+                for i in range( received ):
+                    contact  =  parse( views[i][:messages[i].msg_len] )
+                    if contact is not None:
+                        src_ip, dest_ip, dest_port  =  contact
+                        key  =  ( src_ip << 48 ) | ( dest_ip << 16 ) | dest_port # pack the 3 fields into one int key
+                        remove( key , None ) # re-insert at the end, keeping pending in timestamp order
+                        pending[key]  =  now
 
-                    # === ONLY MODIFY SHARED DICTIONARY WHEN LOCK IS ACQUIRED === #
-                    with self.lock:
-                        self.first_contacts[key]  =  time.time( ) # create entry OR update timestamp
+            # === SWAP THE PENDING BUFFER OUT TO THE FANOUTRATECALCULATOR BY SIZE OR AGE === #
+            now  =  clock( )
+            if len( pending ) >= FLUSH_SIZE or ( pending and now - last_flush >= FLUSH_INTERVAL ):
+                try:
+                    send( pending ) # a new dictionary is started, the queue pickles this one later
+                except Full: # FanOutRateCalculator is behind, never block capture on it
+                    self.dropped_contacts +=  len( pending )
+                pending     =  { }
+                last_flush  =  now